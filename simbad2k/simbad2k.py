@@ -1,10 +1,19 @@
 #!/usr/bin/env python
+from contextlib import closing, contextmanager
 from datetime import datetime
 import hashlib
+import heapq
+import itertools
 import logging
 from logging.config import dictConfig
 import math
 import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import numpy as np
 import requests
 
 from astroquery.exceptions import RemoteServiceError
@@ -15,7 +24,17 @@ from lcogt_logging import LCOGTFormatter
 
 config = {
     'CACHE_TYPE': 'simple',
-    'CACHE_DEFAULT_TIMEOUT': 60 * 60 * 60
+    'CACHE_DEFAULT_TIMEOUT': 60 * 60 * 60,
+    # Sustained queries per second and burst size allowed to each upstream service
+    'UPSTREAM_RATE_LIMITS': {
+        'simbad': {'rate': 5.0, 'burst': 10},
+        'ned': {'rate': 5.0, 'burst': 10},
+        'mpc': {'rate': 2.0, 'burst': 5},
+    },
+    # SQLite database holding the rate limit state shared by all workers on the host
+    'UPSTREAM_RATE_LIMIT_DATABASE': os.path.join(tempfile.gettempdir(), 'simbad2k_rate_limits.sqlite3'),
+    # Maximum number of outbound queries in flight at once in a worker
+    'UPSTREAM_MAX_CONCURRENT_QUERIES': 8,
 }
 
 dictConfig({
@@ -41,11 +60,226 @@ app.config.from_mapping(config)
 cache = Cache(app)
 CORS(app)
 
+# Priorities for outbound queries, lower values are sent to the upstream services first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_WARMUP = 2
+PRIORITIES = {'interactive': PRIORITY_INTERACTIVE, 'batch': PRIORITY_BATCH, 'warmup': PRIORITY_WARMUP}
+
+
+def run_blocking(function, *args):
+    """
+    Run a blocking call that gevent cannot make cooperative, such as a sqlite3 query.
+    Under the gevent worker the call runs in gevent's thread pool, so that it does not stall every other greenlet in
+    the worker while it waits. Otherwise it is simply called.
+    """
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return function(*args)
+    if not monkey.is_module_patched('threading'):
+        return function(*args)
+    return get_hub().threadpool.apply(function, args)
+
+
+class RateLimitStore(object):
+    """
+    Token bucket state kept in a SQLite database, so that it is shared by every worker process on the host.
+    Each take runs in its own write transaction, so two workers can never spend the same token.
+    The database is only created when it is first used.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.created = False
+
+    def _connect(self):
+        # Transactions are tiny, so a writer never has to wait long for the lock
+        connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+        if not self.created:
+            try:
+                # Write ahead logging lets readers carry on while a worker holds the write lock
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                                   '(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            except BaseException:
+                connection.close()
+                raise
+            self.created = True
+        return connection
+
+    def take(self, name, rate, burst):
+        """
+        Take a token from the named bucket if one is available.
+        Returns 0 if a token was taken, otherwise the number of seconds until the next token is available.
+        """
+        return run_blocking(self._take, name, rate, burst)
+
+    def _take(self, name, rate, burst):
+        connection = self._connect()
+        try:
+            # Take the write lock before reading so that the read, refill and update are atomic across processes
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+            now = time.time()
+            tokens = burst if row is None else min(burst, row[0] + max(now - row[1], 0.0) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                delay = 0.0
+            else:
+                delay = (1 - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                               (name, tokens, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+        return delay
+
+    def clear(self):
+        run_blocking(self._clear)
+
+    def _clear(self):
+        with closing(self._connect()) as connection:
+            connection.execute('DELETE FROM buckets')
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter for one upstream, whose state is kept in a RateLimitStore.
+    """
+    def __init__(self, store, name, rate, burst):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def take(self):
+        """
+        Take a token from the bucket if one is available.
+        Returns 0 if a token was taken, otherwise the number of seconds until the next token is available.
+        """
+        return self.store.take(self.name, self.rate, self.burst)
+
+
+class OutboundScheduler(object):
+    """
+    Coordinate outbound queries to the upstream services.
+    Each upstream has its own token bucket, which queries waiting on that upstream take from in priority order, then
+    first come first served. The number of queries in flight at once across all upstreams is also capped, and queries
+    that hold a token are given the concurrency slots from a single queue in the same order, so a query is never sent
+    ahead of a higher priority query to another upstream that is also ready to go.
+    The queues and the concurrency cap belong to one worker process. Only the token buckets are shared between workers,
+    so queries from different workers compete for tokens in arrival order, whatever their priority.
+    Queue depth and wait times are recorded and returned by get_stats().
+    """
+    def __init__(self, store, rate_limits, max_concurrent):
+        self.buckets = {
+            upstream: TokenBucket(store, upstream, limits['rate'], limits['burst'])
+            for upstream, limits in rate_limits.items()
+        }
+        self.max_concurrent = max_concurrent
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.waiting = {upstream: [] for upstream in self.buckets}
+        # Queries that hold a token and are waiting for a concurrency slot, across all upstreams
+        self.ready = []
+        self.in_flight = 0
+        self.stats = {upstream: {'queries': 0, 'total_wait': 0.0, 'max_wait': 0.0} for upstream in self.buckets}
+
+    def _discard(self, upstream, ticket):
+        for queue in (self.waiting[upstream], self.ready):
+            if ticket in queue:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+
+    def _is_next(self, upstream, ticket):
+        return self.waiting[upstream][0] == ticket
+
+    def _is_ready(self, ticket):
+        return self.ready[0] == ticket and self.in_flight < self.max_concurrent
+
+    @contextmanager
+    def slot(self, upstream, priority=PRIORITY_INTERACTIVE):
+        """
+        Context manager that blocks until a query to the given upstream may be sent, and holds a concurrency slot
+        until the block exits.
+        """
+        ticket = (priority, next(self.counter))
+        start = time.monotonic()
+        with self.condition:
+            heapq.heappush(self.waiting[upstream], ticket)
+        try:
+            while True:
+                with self.condition:
+                    while not self._is_next(upstream, ticket):
+                        self.condition.wait()
+                # Only the query at the head of the queue asks for a token. The store is accessed without holding the
+                # lock, and off the gevent hub, so a slow round trip does not hold up queries to the other upstreams.
+                delay = self.buckets[upstream].take()
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+            with self.condition:
+                # The query keeps its place in its upstream's queue until it is sent, so the queries behind it do not
+                # take more tokens while it waits for a slot
+                heapq.heappush(self.ready, ticket)
+                while not self._is_ready(ticket):
+                    self.condition.wait()
+                self._discard(upstream, ticket)
+                self.in_flight += 1
+                wait = time.monotonic() - start
+                stats = self.stats[upstream]
+                stats['queries'] += 1
+                stats['total_wait'] += wait
+                stats['max_wait'] = max(stats['max_wait'], wait)
+                # Let the next query for this upstream move to the head of its queue
+                self.condition.notify_all()
+        except BaseException:
+            # The query gave up while queued, e.g. on a store error or a timeout. Drop its ticket so that it does not
+            # block the queries queued behind it forever.
+            with self.condition:
+                self._discard(upstream, ticket)
+                self.condition.notify_all()
+            raise
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            upstreams = {}
+            for upstream, stats in self.stats.items():
+                upstreams[upstream] = {
+                    'queue_depth': len(self.waiting[upstream]),
+                    'queries': stats['queries'],
+                    'mean_wait': stats['total_wait'] / stats['queries'] if stats['queries'] else 0.0,
+                    'max_wait': stats['max_wait'],
+                }
+            return {
+                'in_flight': self.in_flight,
+                'max_concurrent': self.max_concurrent,
+                'waiting_for_slot': len(self.ready),
+                'upstreams': upstreams
+            }
+
+
+rate_limit_store = RateLimitStore(app.config['UPSTREAM_RATE_LIMIT_DATABASE'])
+scheduler = OutboundScheduler(
+    rate_limit_store, app.config['UPSTREAM_RATE_LIMITS'], app.config['UPSTREAM_MAX_CONCURRENT_QUERIES']
+)
+
 
 class PlanetQuery(object):
-    def __init__(self, query, scheme):
+    def __init__(self, query, scheme, priority=PRIORITY_INTERACTIVE):
         self.query = query.lower()
         self.scheme = scheme
+        self.priority = priority
 
     def get_result(self):
         import json
@@ -55,10 +289,11 @@ class PlanetQuery(object):
 
 
 class SimbadQuery(object):
-    def __init__(self, query, scheme):
+    def __init__(self, query, scheme, priority=PRIORITY_INTERACTIVE):
         self.simbad = self._get_simbad_instance()
         self.query = query
         self.scheme = scheme
+        self.priority = priority
 
     def _get_simbad_instance(self):
         from astroquery.simbad import Simbad
@@ -69,7 +304,8 @@ class SimbadQuery(object):
         return simbad
 
     def get_result(self):
-        result = self.simbad.query_object(self.query)
+        with scheduler.slot('simbad', self.priority):
+            result = self.simbad.query_object(self.query)
         if result:
             ret_dict = {}
             for key in ['pmra', 'pmdec', 'ra', 'dec', 'plx_value', 'main_id']:
@@ -93,8 +329,9 @@ class MPCQuery(object):
     Next submit the primary designation to the MPC via astroquery to get the object's orbital elements.
     Returns a dictionary of the object's orbital elements.
     """
-    def __init__(self, query, scheme):
+    def __init__(self, query, scheme, priority=PRIORITY_INTERACTIVE):
         self.query = query
+        self.priority = priority
         self.keys = [
             'argument_of_perihelion', 'ascending_node', 'eccentricity',
             'inclination', 'mean_anomaly', 'semimajor_axis', 'perihelion_date_jd',
@@ -145,8 +382,9 @@ class MPCQuery(object):
             * Return the first target with a 'permid' if searching for a comet.
             * If no 'permid' is found, query the MPC again using the first target with a preliminary designation.
         """
-        response = requests.get("https://data.minorplanetcenter.net/api/query-identifier",
-                                data=self.query.replace("+", " ").upper())
+        with scheduler.slot('mpc', self.priority):
+            response = requests.get("https://data.minorplanetcenter.net/api/query-identifier",
+                                    data=self.query.replace("+", " ").upper())
         identifications = response.json()
         if identifications.get('object_type') and\
                 identifications.get('object_type')[1] not in self.mpc_type_mapping[self.scheme]:
@@ -172,8 +410,9 @@ class MPCQuery(object):
                 if target.get('unpacked_primary_provisional_designation'):
                     # We need to re-check preliminary designations for multiple targets because these are sometimes
                     # returned by the MPC for disambiguation even though the targets have primary IDs
-                    response = requests.get("https://data.minorplanetcenter.net/api/query-identifier",
-                                data=target['unpacked_primary_provisional_designation'])
+                    with scheduler.slot('mpc', self.priority):
+                        response = requests.get("https://data.minorplanetcenter.net/api/query-identifier",
+                                                data=target['unpacked_primary_provisional_designation'])
                     identifications = response.json()
                     break
         return identifications['permid'], identifications['unpacked_primary_provisional_designation']
@@ -203,7 +442,8 @@ class MPCQuery(object):
                 designation = primary_provisional_designation
             else:
                 return None
-            result = MPC.query_objects_async(**params).json()
+            with scheduler.slot('mpc', self.priority):
+                result = MPC.query_objects_async(**params).json()
             # There are 2 conditions under which we can get back multiple sets of elements:
             # 1. When the search is for a comet and there are multiple types with the same number (e.g. 1P/1I)
             # 2. When the search has multiple sets of elements with different epochs
@@ -240,15 +480,17 @@ class MPCQuery(object):
 
 
 class NEDQuery(object):
-    def __init__(self, query, scheme):
+    def __init__(self, query, scheme, priority=PRIORITY_INTERACTIVE):
         self.query = query
         self.scheme = scheme
+        self.priority = priority
 
     def get_result(self):
         from astroquery.ipac.ned import Ned
         ret_dict = {}
         try:
-            result_table = Ned.query_object(self.query)
+            with scheduler.slot('ned', self.priority):
+                result_table = Ned.query_object(self.query)
         except RemoteServiceError:
             return None
         if len(result_table) == 0:
@@ -264,6 +506,83 @@ NON_SIDEREAL_QUERY_CLASSES = [PlanetQuery, MPCQuery]
 QUERY_CLASSES_BY_TARGET_TYPE = {'sidereal': SIDEREAL_QUERY_CLASSES, 'non_sidereal': NON_SIDEREAL_QUERY_CLASSES}
 
 
+# Reference epoch (Julian year) of the positions and proper motions returned by SIMBAD
+SIMBAD_REFERENCE_EPOCH = 2000.0
+MAS_TO_DEG = 1.0 / 3.6e6
+# Epochs further than this many years from the reference epoch are rejected, as the linear propagation of proper
+# motion is not meaningful over longer spans
+MAX_EPOCH_OFFSET = 3000.0
+EPOCH_PATTERN = re.compile(r'J?\d+(\.\d+)?')
+
+
+def propagate_proper_motion(ra, dec, pmra, pmdec, epoch, reference_epoch=SIMBAD_REFERENCE_EPOCH):
+    """
+    Propagate ICRS positions from the reference epoch to the given epoch by applying proper motion.
+    All arguments may be scalars or arrays, so many targets can be propagated in a single call. ra and dec are in
+    degrees, pmra (which includes the cos(dec) factor, as returned by SIMBAD) and pmdec are in mas/yr, and the epochs
+    are Julian years. The motion is applied along the tangent plane and the result projected back onto the sphere, which
+    keeps targets near the poles well behaved. Missing proper motions (NaN) are treated as zero.
+    Returns a tuple of arrays (ra, dec) in degrees.
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    dt = np.asarray(epoch, dtype=float) - np.asarray(reference_epoch, dtype=float)
+    pmra = np.radians(np.nan_to_num(np.asarray(pmra, dtype=float)) * MAS_TO_DEG)
+    pmdec = np.radians(np.nan_to_num(np.asarray(pmdec, dtype=float)) * MAS_TO_DEG)
+    sin_ra, cos_ra = np.sin(ra), np.cos(ra)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+    # Unit vector towards the target and the local east (p) and north (q) directions
+    x, y, z = cos_dec * cos_ra, cos_dec * sin_ra, sin_dec
+    px, py = -sin_ra, cos_ra
+    qx, qy, qz = -sin_dec * cos_ra, -sin_dec * sin_ra, cos_dec
+    x = x + dt * (pmra * px + pmdec * qx)
+    y = y + dt * (pmra * py + pmdec * qy)
+    z = z + dt * pmdec * qz
+    new_ra = np.degrees(np.arctan2(y, x)) % 360.0
+    new_dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return new_ra, new_dec
+
+
+def apply_epoch(results, epoch):
+    """
+    Return copies of the given query results with their positions given at the given epoch (Julian year).
+    Every result with a position is marked with the epoch. Results that also have a proper motion are propagated to
+    the epoch in a single vectorized call, and the positions of the others are valid at any epoch. Results without a
+    position, such as non-sidereal targets, are returned unchanged.
+    """
+    results = [dict(result) for result in results]
+    positioned = [result for result in results if 'ra_d' in result and 'dec_d' in result]
+    movers = [result for result in positioned if 'pmra' in result or 'pmdec' in result]
+    if movers:
+        ra, dec = propagate_proper_motion(
+            [result['ra_d'] for result in movers],
+            [result['dec_d'] for result in movers],
+            [result.get('pmra', 0.0) for result in movers],
+            [result.get('pmdec', 0.0) for result in movers],
+            epoch
+        )
+        for result, new_ra, new_dec in zip(movers, ra, dec):
+            result['ra'] = result['ra_d'] = float(new_ra)
+            result['dec'] = result['dec_d'] = float(new_dec)
+    for result in positioned:
+        result['epoch'] = epoch
+    return results
+
+
+def parse_epoch(epoch):
+    """
+    Parse an epoch given as a Julian year, optionally prefixed with J (e.g. 2024.5 or J2024.5).
+    Returns the epoch as a float, or None if it cannot be parsed or is too far from the reference epoch.
+    """
+    epoch = epoch.strip().upper()
+    if not EPOCH_PATTERN.fullmatch(epoch):
+        return None
+    epoch = float(epoch.removeprefix('J'))
+    if abs(epoch - SIMBAD_REFERENCE_EPOCH) > MAX_EPOCH_OFFSET:
+        return None
+    return epoch
+
+
 def generate_cache_key(query, scheme, target_type):
     cache_key = hashlib.sha3_256()
     cache_key.update(query.encode())
@@ -279,7 +598,17 @@ def root(query):
     logger.log(msg=f'Received query for target {query}.', level=logging.INFO)
     target_type = request.args.get('target_type', '')
     scheme = request.args.get('scheme', '')
+    epoch = request.args.get('epoch')
+    priority = request.args.get('priority', 'interactive')
     logger.log(msg=f'Using search parameters scheme={scheme}, target_type={target_type}', level=logging.INFO)
+    if epoch is not None:
+        epoch = parse_epoch(epoch)
+        if epoch is None:
+            return jsonify({'error': f'Invalid epoch, expected a Julian year such as 2024.5 within '
+                                     f'{MAX_EPOCH_OFFSET:g} years of J{SIMBAD_REFERENCE_EPOCH:g}'})
+    if priority.lower() not in PRIORITIES:
+        return jsonify({'error': f'Invalid priority, expected one of {", ".join(PRIORITIES)}'})
+    # Results are always cached at the catalog epoch, so propagating to a different epoch needs no upstream query
     cache_key = generate_cache_key(query, scheme, target_type)
     result = cache.get(cache_key)
 
@@ -288,24 +617,34 @@ def root(query):
         if target_type:
             query_classes = QUERY_CLASSES_BY_TARGET_TYPE[target_type.lower()]
         for query_class in query_classes:
-            result = query_class(query, scheme.lower()).get_result()
+            result = query_class(query, scheme.lower(), PRIORITIES[priority.lower()]).get_result()
             if result:
                 cache.set(cache_key, result, timeout=60 * 60 * 60)
                 logger.log(msg=f'Found target for {query} via {query_class.__name__} with data {result}',
                            level=logging.INFO)
+                if epoch is not None:
+                    result = apply_epoch([result], epoch)[0]
                 return jsonify(**result)
         logger.log(msg=f'Unable to find result for name {query}.', level=logging.INFO)
         return jsonify({'error': 'No match found'})
     logger.log(msg=f'Found cached target for {query} with data {result}', level=logging.INFO)
+    if epoch is not None:
+        result = apply_epoch([result], epoch)[0]
     return jsonify(**result)
 
 
+@app.route('/_scheduler')
+def scheduler_stats():
+    return jsonify(**scheduler.get_stats())
+
+
 @app.route('/')
 def index():
     instructions = ('This is simbad2k. To query for a sidereal object, use '
                     '/&lt;object&gt;?target_type=&lt;sidereal or non_sidereal&gt;. '
                     'For non_sidereal targets, you must include scheme, which can be '
-                    'either mpc_minor_planet or mpc_comet.'
+                    'either mpc_minor_planet or mpc_comet. '
+                    'For sidereal targets, add epoch=&lt;Julian year&gt; to apply proper motion to the position. '
                     'Ex: <a href="/103P?target_type=non_sidereal&scheme=mpc_comet">'
                     '/103P?target_type=non_sidereal&scheme=mpc_comet</a>')
     return instructions
@@ -1,8 +1,19 @@
 """
 test_simbad2k.py - Tests for the simbad2k service.
 """
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+from contextlib import closing
+
 import pytest
-from astropy.table import Table
+from astropy.table import Column, Table
 from astroquery.mpc import MPC
 from astroquery.ipac.ned import Ned
 
@@ -19,6 +30,24 @@ def client():
     simbad2k.cache.clear()
 
 
+@pytest.fixture
+def rate_limit_store(tmp_path):
+    return simbad2k.RateLimitStore(str(tmp_path / 'rate_limits.sqlite3'))
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch, rate_limit_store):
+    # Keep the rate limit state of each test in its own database, away from that of any running instance
+    scheduler = simbad2k.OutboundScheduler(
+        rate_limit_store,
+        simbad2k.app.config['UPSTREAM_RATE_LIMITS'],
+        simbad2k.app.config['UPSTREAM_MAX_CONCURRENT_QUERIES']
+    )
+    monkeypatch.setattr(simbad2k, 'rate_limit_store', rate_limit_store)
+    monkeypatch.setattr(simbad2k, 'scheduler', scheduler)
+    return scheduler
+
+
 @pytest.fixture
 def mock_mpc_response():
     # Return an astroquery MPC response that has no results, where results can be added in the tests. The astroquery
@@ -180,3 +209,256 @@ def test_mpc_result_field_as_null_does_not_crash(client, mock_mpc_response, come
     response = client.get('/29P?target_type=non_sidereal&scheme=mpc_comet')
     assert response.status_code == 200
     assert response.get_json()['mean_anomaly'] is None
+
+
+@pytest.fixture
+def barnards_star_simbad_table_row():
+    return {
+        'ra': 269.45207511,
+        'dec': 4.69336586,
+        'pmra': -801.551,
+        'pmdec': 10362.394,
+        'plx_value': 546.9759,
+        'main_id': "NAME Barnard's star"
+    }
+
+
+def test_proper_motion_is_applied_for_requested_epoch(client, mock_simbad_response, barnards_star_simbad_table_row):
+    mock_simbad_response.add_row(barnards_star_simbad_table_row)
+    response_json = client.get('/barnards_star?target_type=sidereal&epoch=J2020').get_json()
+    # Over 20 years Barnard's star moves about 207 arcseconds, almost entirely to the north
+    assert response_json['dec'] == pytest.approx(4.69336586 + 20 * 10362.394 / 3.6e6, abs=1e-6)
+    assert response_json['ra'] == pytest.approx(269.45207511 + 20 * -801.551 / 3.6e6 / 0.99664, abs=1e-5)
+    assert response_json['ra_d'] == response_json['ra']
+    assert response_json['dec_d'] == response_json['dec']
+    assert response_json['epoch'] == 2020.0
+
+
+def test_cached_result_is_kept_at_catalog_epoch(client, mock_simbad_response, barnards_star_simbad_table_row):
+    mock_simbad_response.add_row(barnards_star_simbad_table_row)
+    client.get('/barnards_star?target_type=sidereal&epoch=2020')
+    response_json = client.get('/barnards_star?target_type=sidereal').get_json()
+    assert response_json['ra'] == barnards_star_simbad_table_row['ra']
+    assert response_json['dec'] == barnards_star_simbad_table_row['dec']
+    assert 'epoch' not in response_json
+
+
+def test_epoch_does_not_move_target_without_proper_motion(client, mock_simbad_response, m88_simbad_table_row):
+    mock_simbad_response.add_row(m88_simbad_table_row)
+    response_json = client.get('/m88?target_type=sidereal&epoch=2050').get_json()
+    assert response_json['ra'] == m88_simbad_table_row['ra']
+    assert response_json['dec'] == m88_simbad_table_row['dec']
+    assert response_json['epoch'] == 2050.0
+
+
+def test_epoch_is_set_on_ned_result(client, mock_ned_response):
+    # The NED query class reads the RA, DEC and Object Name columns
+    mock_ned_response.rename_column('RA(deg)', 'RA')
+    mock_ned_response.rename_column('DEC(deg)', 'DEC')
+    mock_ned_response.add_column(Column(name='Object Name', dtype='U32'))
+    mock_ned_response.add_row({'RA': 202.484167, 'DEC': 47.230556, 'Object Name': 'MESSIER 051'})
+    response_json = client.get('/m51?target_type=sidereal&epoch=2050').get_json()
+    assert response_json['ra_d'] == 202.484167
+    assert response_json['dec_d'] == 47.230556
+    assert response_json['epoch'] == 2050.0
+
+
+def test_epoch_is_not_set_on_non_sidereal_result(client):
+    response_json = client.get('/mars?target_type=non_sidereal&epoch=2050').get_json()
+    assert 'epoch' not in response_json
+
+
+@pytest.mark.parametrize('epoch', ['yesterday', 'JJ2020', 'nan', '', '2_024', '1e3', '-2020', '1e12', '1e300', '5001',
+                                   '999999999999'])
+def test_invalid_epoch_returns_error(client, epoch):
+    response_json = client.get(f'/m88?target_type=sidereal&epoch={epoch}').get_json()
+    assert 'error' in response_json
+
+
+@pytest.mark.parametrize('epoch', ['2000', ' j2024.5 ', '5000', '1000.25'])
+def test_valid_epoch_is_accepted(client, mock_simbad_response, m88_simbad_table_row, epoch):
+    mock_simbad_response.add_row(m88_simbad_table_row)
+    response_json = client.get(f'/m88?target_type=sidereal&epoch={epoch}').get_json()
+    assert 'error' not in response_json
+    assert response_json['epoch'] == float(epoch.strip().lower().removeprefix('j'))
+
+
+def test_propagate_proper_motion_is_vectorized():
+    ra, dec = simbad2k.propagate_proper_motion(
+        [10.0, 200.0, 359.9999], [0.0, 45.0, -30.0], [0.0, 0.0, 3600.0], [3600.0, float('nan'), 0.0], 2010.0
+    )
+    assert ra.shape == dec.shape == (3,)
+    assert dec[0] == pytest.approx(0.01, abs=1e-8)
+    assert ra[0] == pytest.approx(10.0)
+    # Missing proper motion components are treated as zero
+    assert ra[1] == pytest.approx(200.0)
+    assert dec[1] == pytest.approx(45.0)
+    # Right ascension wraps around to stay within [0, 360)
+    assert 0.0 <= ra[2] < 1.0
+
+
+def test_token_bucket_allows_burst_then_limits(rate_limit_store):
+    bucket = simbad2k.TokenBucket(rate_limit_store, 'test', rate=1.0, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 1.0
+
+
+def test_token_bucket_is_shared_between_processes(rate_limit_store):
+    # Spend the whole burst from other processes, as other gunicorn workers would
+    with multiprocessing.Pool(4) as pool:
+        delays = pool.starmap(rate_limit_store.take, [('test', 0.01, 20)] * 24)
+    assert sum(delay == 0 for delay in delays) == 20
+    assert simbad2k.TokenBucket(rate_limit_store, 'test', rate=0.01, burst=20).take() > 0
+
+
+def test_rate_limit_store_closes_its_connections(rate_limit_store, monkeypatch):
+    connections = []
+    connect = rate_limit_store._connect
+
+    def tracking_connect():
+        connections.append(connect())
+        return connections[-1]
+
+    monkeypatch.setattr(rate_limit_store, '_connect', tracking_connect)
+    rate_limit_store.take('test', 1.0, 1)
+    rate_limit_store.clear()
+    assert len(connections) == 2
+    for connection in connections:
+        # Closed connections refuse to run statements
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+
+
+def test_scheduler_releases_interactive_queries_before_batch_queries(rate_limit_store):
+    scheduler = simbad2k.OutboundScheduler(rate_limit_store, {'test': {'rate': 1000.0, 'burst': 1000}}, 1)
+    order = []
+
+    def query(priority):
+        with scheduler.slot('test', priority):
+            order.append(priority)
+
+    # Hold the only concurrency slot so that the other queries have to queue up behind it
+    with scheduler.slot('test'):
+        threads = [threading.Thread(target=query, args=(simbad2k.PRIORITY_WARMUP,)),
+                   threading.Thread(target=query, args=(simbad2k.PRIORITY_BATCH,)),
+                   threading.Thread(target=query, args=(simbad2k.PRIORITY_INTERACTIVE,))]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        assert scheduler.get_stats()['upstreams']['test']['queue_depth'] == 3
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == [simbad2k.PRIORITY_INTERACTIVE, simbad2k.PRIORITY_BATCH, simbad2k.PRIORITY_WARMUP]
+
+
+def test_scheduler_gives_slots_to_interactive_queries_before_warmup_queries_to_other_upstreams(rate_limit_store):
+    rate_limits = {'simbad': {'rate': 1000.0, 'burst': 1000}, 'ned': {'rate': 1000.0, 'burst': 1000}}
+    scheduler = simbad2k.OutboundScheduler(rate_limit_store, rate_limits, 1)
+    order = []
+
+    def query(upstream, priority):
+        with scheduler.slot(upstream, priority):
+            order.append(upstream)
+
+    # Hold the only concurrency slot so that the other queries have to queue up behind it
+    with scheduler.slot('simbad'):
+        threads = [threading.Thread(target=query, args=('ned', simbad2k.PRIORITY_WARMUP)),
+                   threading.Thread(target=query, args=('simbad', simbad2k.PRIORITY_INTERACTIVE))]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        assert scheduler.get_stats()['waiting_for_slot'] == 2
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ['simbad', 'ned']
+
+
+def test_scheduler_drops_query_that_fails_while_queued(rate_limit_store):
+    class FailingStore:
+        def take(self, *args, **kwargs):
+            raise sqlite3.OperationalError('database is locked')
+
+    scheduler = simbad2k.OutboundScheduler(FailingStore(), {'test': {'rate': 1000.0, 'burst': 1000}}, 1)
+    with pytest.raises(sqlite3.OperationalError):
+        with scheduler.slot('test'):
+            pass
+    assert scheduler.get_stats()['upstreams']['test']['queue_depth'] == 0
+    assert scheduler.get_stats()['in_flight'] == 0
+    # Later queries for the same upstream are not blocked by the failed one
+    scheduler.buckets['test'].store = rate_limit_store
+
+    def query():
+        with scheduler.slot('test'):
+            pass
+
+    thread = threading.Thread(target=query, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_rate_limit_store_does_not_stall_gevent_worker_while_waiting_for_lock(rate_limit_store):
+    pytest.importorskip('gevent')
+    # Run the store under a monkey patched gevent worker, as gunicorn does, and count how often another greenlet
+    # gets to run while the store waits for a lock held by another worker
+    script = textwrap.dedent("""
+        from gevent import monkey
+        monkey.patch_all()
+        import sqlite3
+        import sys
+        import time
+        import gevent
+        from simbad2k import simbad2k
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(time.monotonic())
+                gevent.sleep(0.01)
+
+        gevent.spawn(tick)
+        gevent.sleep(0.05)
+        start = time.monotonic()
+        try:
+            simbad2k.RateLimitStore(sys.argv[1]).take('test', 1.0, 1)
+        except sqlite3.OperationalError:
+            pass
+        end = time.monotonic()
+        print(end - start, len([t for t in ticks if start <= t <= end]))
+    """)
+    rate_limit_store.take('test', 1.0, 1)
+    with closing(sqlite3.connect(rate_limit_store.path, isolation_level=None)) as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        output = subprocess.run(
+            [sys.executable, '-c', script, rate_limit_store.path], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        ).stdout
+        connection.execute('ROLLBACK')
+    waited, ticks = output.split()
+    assert float(waited) > 0.5
+    assert int(ticks) > 10
+
+
+def test_rate_limit_store_is_created_on_first_use(tmp_path):
+    path = tmp_path / 'rate_limits.sqlite3'
+    store = simbad2k.RateLimitStore(str(path))
+    assert not path.exists()
+    assert store.take('test', 1.0, 1) == 0
+    assert path.exists()
+
+
+def test_scheduler_stats_are_exposed(client, mock_simbad_response, m88_simbad_table_row):
+    mock_simbad_response.add_row(m88_simbad_table_row)
+    queries_before = client.get('/_scheduler').get_json()['upstreams']['simbad']['queries']
+    client.get('/m88?target_type=sidereal&priority=batch')
+    stats = client.get('/_scheduler').get_json()
+    assert stats['upstreams']['simbad']['queries'] == queries_before + 1
+    assert stats['upstreams']['simbad']['queue_depth'] == 0
+    assert stats['in_flight'] == 0
+
+
+def test_invalid_priority_returns_error(client):
+    response_json = client.get('/m88?target_type=sidereal&priority=urgent').get_json()
+    assert 'error' in response_json